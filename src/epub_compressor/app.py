@@ -1,6 +1,6 @@
 import streamlit as st
 
-from epub_compressor.compress import compress_epub
+from epub_compressor.compress import DEFAULT_MAX_DIMENSION, compress_epub
 
 
 def main():
@@ -15,10 +15,15 @@ def main():
 
         quality = st.slider("Select quality (1-100)", 1, 100, 75)
         img_format = st.radio("Select image format", ("WEBP", "AVIF"))
+        max_dimension = st.slider(
+            "Max image dimension (px)", 480, 4096, DEFAULT_MAX_DIMENSION
+        )
 
         if st.button("Compress"):
             with st.spinner("Compressing..."):
-                compressed = compress_epub(epub_file, quality, img_format)
+                compressed = compress_epub(
+                    epub_file, quality, img_format, max_dimension=max_dimension
+                )
                 if compressed:
                     st.download_button(
                         label="Download",
@@ -1,5 +1,12 @@
 import argparse
-from epub_compressor.compress import compress_epub
+import os
+import tempfile
+from epub_compressor.compress import (
+    DEFAULT_AVIF_SPEED,
+    DEFAULT_MAX_DIMENSION,
+    avif_codec_available,
+    compress_epub,
+)
 
 
 def main():
@@ -22,22 +29,92 @@ def main():
         choices=["WEBP", "AVIF"],
         help="Image format to convert.",
     )
+    parser.add_argument(
+        "--codec",
+        type=str,
+        default="auto",
+        choices=["auto", "aom", "rav1e", "svt"],
+        help="AV1 encoder used for AVIF output.",
+    )
+    parser.add_argument(
+        "--speed",
+        type=int,
+        default=DEFAULT_AVIF_SPEED,
+        help="AVIF encoder speed (0-10, higher is faster).",
+    )
+    parser.add_argument(
+        "--max-dim",
+        type=int,
+        default=DEFAULT_MAX_DIMENSION,
+        help=(
+            "Downscale images whose longest edge exceeds this many pixels "
+            "(0 to disable)."
+        ),
+    )
+    parser.add_argument(
+        "--target-bpp",
+        type=float,
+        help=(
+            "Search image quality to hit this many bits per pixel "
+            "instead of using --quality."
+        ),
+    )
+    parser.add_argument(
+        "--keep-alpha",
+        action="store_true",
+        help="Keep alpha channels even when images are fully opaque.",
+    )
     parser.add_argument(
         "-o", "--output_path", type=str, help="Path to save the compressed EPUB file."
     )
     args = parser.parse_args()
 
-    out = compress_epub(args.input_path, args.quality, args.format)
+    if args.format == "AVIF" and not avif_codec_available(args.codec):
+        parser.error(
+            f"AVIF codec {args.codec!r} is not available in this libavif build"
+        )
 
+    output_path = (
+        args.output_path if args.output_path else f"{args.input_path}-compressed.epub"
+    )
+    # Write next to the destination and move it into place only once the
+    # whole archive is done, so a failure (or -o pointing at the input)
+    # never truncates or removes an existing file.
     try:
-        output_path = (
-            args.output_path
-            if args.output_path
-            else f"{args.input_path}-compressed.epub"
+        tmp = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(output_path)),
+            suffix=".epub",
+            delete=False,
         )
-        with open(output_path, "wb") as f:
-            f.write(out.getvalue())
-    except:
+    except OSError:
+        print("Error writing file.")
+        return
+
+    try:
+        with tmp:
+            compress_epub(
+                args.input_path,
+                args.quality,
+                args.format,
+                args.codec,
+                args.speed,
+                args.max_dim,
+                args.target_bpp,
+                args.keep_alpha,
+                output=tmp,
+            )
+    except BaseException:
+        os.remove(tmp.name)
+        raise
+
+    try:
+        # NamedTemporaryFile is created 0600; give the result normal permissions.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp.name, 0o666 & ~umask)
+        os.replace(tmp.name, output_path)
+    except OSError:
+        os.remove(tmp.name)
         print("Error writing file.")
 
 
@@ -1,61 +1,518 @@
 import logging
 import mimetypes
-from typing import Literal, Tuple
+import os
+import posixpath
+import xml.etree.ElementTree as ET
+from typing import BinaryIO, Callable, Literal, Tuple, TypeVar, overload
 from PIL import Image
 import io
 import concurrent.futures
+import copy
+import functools
+import hashlib
 import pillow_avif
+import queue
+import struct
 import zipfile
+from collections import Counter, deque
+from urllib.parse import unquote
+
+# Upper bound on encodes in flight at once; more only adds contention with
+# the encoders' own threads and keeps extra decoded images in memory.
+MAX_CONCURRENT_ENCODES = 4
+
+# AVIF encodes are tiled and threaded per image, so fewer run side by side.
+MAX_CONCURRENT_AVIF_ENCODES = 2
+
+# Re-encoded images must come out at least this much smaller than the source,
+# otherwise the original is kept.
+MIN_SIZE_RATIO = 0.95
+
+# Entry that EPUB requires to come first in the archive, stored uncompressed.
+MIMETYPE_ENTRY = "mimetype"
+
+CONTAINER_ENTRY = "META-INF/container.xml"
+
+COPY_BUFFER_SIZE = 64 * 1024
+
+# Small images are sent to workers in batches so per-task pickling and IPC
+# overhead is amortised; a batch closes at whichever limit it hits first.
+ENCODE_BATCH_SIZE = 8
+ENCODE_BATCH_BYTES = 256 * 1024
+
+AvifCodec = Literal["auto", "aom", "rav1e", "svt"]
+
+# libavif speed, 0 (slowest, best) to 10 (fastest).
+DEFAULT_AVIF_SPEED = 6
+
+# Longest edge, in pixels, that images are downscaled to before encoding.
+DEFAULT_MAX_DIMENSION = 1600
+
+# Quality range and step budget when searching for a target bits-per-pixel,
+# and how close to the target size counts as a hit.
+QUALITY_SEARCH_RANGE = (10, 95)
+QUALITY_SEARCH_STEPS = 4
+QUALITY_SEARCH_TOLERANCE = 0.025
+
+# Output buffers are reused across encodes within a worker process.
+_buffer_pool: queue.LifoQueue[io.BytesIO] = queue.LifoQueue()
+
+
+def avif_codec_available(codec: AvifCodec) -> bool:
+    return codec == "auto" or pillow_avif._avif.encoder_codec_available(codec)
+
+
+def acquire_buffer() -> io.BytesIO:
+    try:
+        return _buffer_pool.get_nowait()
+    except queue.Empty:
+        return io.BytesIO()
+
+
+def release_buffer(buffer: io.BytesIO) -> None:
+    _buffer_pool.put_nowait(buffer)
+
+
+def sniff_format(image: bytes) -> str | None:
+    if image.startswith(b"\xff\xd8"):
+        return "JPEG"
+    if image[:4] == b"RIFF" and image[8:12] == b"WEBP":
+        return "WEBP"
+    if image[4:12] in (b"ftypavif", b"ftypavis"):
+        return "AVIF"
+    return None
+
+
+def is_opaque(img: Image.Image) -> bool:
+    # Scan only the alpha band rather than the extrema of every band.
+    return img.getchannel("A").getextrema() == (255, 255)
+
+
+def encode_image(
+    img: Image.Image,
+    output_io: io.BytesIO,
+    img_format: Literal["WEBP", "AVIF"],
+    quality: int,
+    save_kwargs: dict,
+) -> bytes:
+    # Overwrite in place rather than truncating, which would free the
+    # buffer's storage; only the bytes written by this save are returned.
+    output_io.seek(0)
+    img.save(output_io, format=img_format, quality=quality, **save_kwargs)
+    size = output_io.tell()
+    with output_io.getbuffer() as view:
+        return bytes(view[:size])
+
+
+def search_quality(
+    img: Image.Image,
+    output_io: io.BytesIO,
+    img_format: Literal["WEBP", "AVIF"],
+    target_size: float,
+    save_kwargs: dict,
+) -> bytes:
+    """Bisect quality towards target_size.
+
+    Returns the first encode within the tolerance either side of the target,
+    otherwise the largest one that fits under it (or the smallest tried).
+    """
+    low, high = QUALITY_SEARCH_RANGE
+
+    # If even the highest quality fits, there is nothing to trade away.
+    best = encode_image(img, output_io, img_format, high, save_kwargs)
+    if len(best) <= target_size:
+        return best
+    high -= 1
+
+    for _ in range(QUALITY_SEARCH_STEPS - 1):
+        if low > high:
+            break
+        quality = (low + high) // 2
+        output = encode_image(img, output_io, img_format, quality, save_kwargs)
+        if abs(len(output) - target_size) <= target_size * QUALITY_SEARCH_TOLERANCE:
+            return output
+        if len(output) > target_size:
+            high = quality - 1
+            if len(output) < len(best):
+                best = output
+        else:
+            low = quality + 1
+            if len(best) > target_size or len(output) > len(best):
+                best = output
+
+    return best
 
 
 def convert_image(
-    image: bytes, quality: int, img_format: Literal["WEBP", "AVIF"]
+    image: bytes,
+    quality: int,
+    img_format: Literal["WEBP", "AVIF"],
+    codec: AvifCodec = "auto",
+    speed: int = DEFAULT_AVIF_SPEED,
+    max_dimension: int | None = DEFAULT_MAX_DIMENSION,
+    target_bpp: float | None = None,
+    keep_alpha: bool = False,
 ) -> bytes:
+    save_kwargs = {}
+    if img_format == "AVIF":
+        save_kwargs.update(
+            codec=codec,
+            speed=speed,
+            max_threads=os.cpu_count() or 1,
+            autotiling=True,
+        )
+
+    output_io = acquire_buffer()
     try:
-        img = Image.open(io.BytesIO(image))
-        output_io = io.BytesIO()
-        img.save(output_io, format=img_format, quality=quality)
-        return output_io.getvalue()
+        with Image.open(io.BytesIO(image)) as img:
+            if max_dimension:
+                ratio = max_dimension / max(img.size)
+                if ratio < 1:
+                    width, height = img.size
+                    size = (max(1, int(width * ratio)), max(1, int(height * ratio)))
+                    # Let libjpeg do a coarse scaled decode, then finish with
+                    # Lanczos; a no-op for other formats.
+                    if img.format == "JPEG":
+                        img.draft(img.mode, size)
+                    img = img.resize(size, Image.Resampling.LANCZOS)
+            # A fully opaque alpha channel is dead weight for the encoder.
+            if not keep_alpha and img.mode in ("RGBA", "LA") and is_opaque(img):
+                img = img.convert(img.mode[:-1])
+            if target_bpp:
+                width, height = img.size
+                return search_quality(
+                    img,
+                    output_io,
+                    img_format,
+                    target_bpp * width * height / 8,
+                    save_kwargs,
+                )
+            return encode_image(img, output_io, img_format, quality, save_kwargs)
     except Exception as e:
         logging.error(f"Error converting image: {e}")
         return image
+    finally:
+        release_buffer(output_io)
+
+
+def local_name(tag: str) -> str:
+    return tag.rpartition("}")[2]
+
+
+def read_manifest(book: zipfile.ZipFile) -> dict[str, str]:
+    """Map archive paths to the media types declared in the OPF manifest."""
+    try:
+        with book.open(CONTAINER_ENTRY) as container:
+            opf_path = next(
+                elem.get("full-path")
+                for _, elem in ET.iterparse(container)
+                if local_name(elem.tag) == "rootfile" and elem.get("full-path")
+            )
+
+        manifest = {}
+        opf_dir = posixpath.dirname(opf_path)
+        with book.open(opf_path) as opf:
+            for _, elem in ET.iterparse(opf):
+                if local_name(elem.tag) == "item" and elem.get("href"):
+                    path = posixpath.normpath(
+                        posixpath.join(opf_dir, unquote(elem.get("href")))
+                    )
+                    manifest[path] = elem.get("media-type", "")
+        return manifest
+    except (KeyError, StopIteration, ET.ParseError) as e:
+        logging.warning(f"Could not read OPF manifest: {e!r}")
+        return {}
+
+
+def should_convert(filename: str, manifest: dict[str, str]) -> bool:
+    mime_type = manifest.get(filename)
+    if mime_type is None:
+        mime_type, _ = mimetypes.guess_type(filename)
+    return bool(
+        mime_type
+        and mime_type.startswith("image")
+        # SVG is markup, not a raster image.
+        and mime_type != "image/svg+xml"
+        and "cover" not in filename.lower()
+    )
+
+
+def fits_within(image: bytes, max_dimension: int | None) -> bool:
+    if not max_dimension:
+        return True
+    try:
+        # Only the header is parsed here; pixel data is not decoded.
+        with Image.open(io.BytesIO(image)) as img:
+            return max(img.size) <= max_dimension
+    except Exception:
+        return True
 
 
 def process_file(
-    item: zipfile.ZipInfo,
+    filename: str,
+    file_content: bytes,
+    quality: int,
+    img_format: Literal["WEBP", "AVIF"],
+    codec: AvifCodec = "auto",
+    speed: int = DEFAULT_AVIF_SPEED,
+    max_dimension: int | None = DEFAULT_MAX_DIMENSION,
+    target_bpp: float | None = None,
+    keep_alpha: bool = False,
+) -> Tuple[str, bytes]:
+    if sniff_format(file_content) != img_format or not fits_within(
+        file_content, max_dimension
+    ):
+        converted = convert_image(
+            file_content,
+            quality,
+            img_format,
+            codec,
+            speed,
+            max_dimension,
+            target_bpp,
+            keep_alpha,
+        )
+        if len(converted) < len(file_content) * MIN_SIZE_RATIO:
+            return filename, converted
+
+    return filename, file_content
+
+
+def process_batch(
+    encode: Callable[[str, bytes], Tuple[str, bytes]],
+    files: list[Tuple[str, bytes]],
+) -> list[Tuple[str, bytes]]:
+    return [encode(filename, file_content) for filename, file_content in files]
+
+
+class Batch:
+    """Images collected for a single worker task."""
+
+    def __init__(self) -> None:
+        self.files: list[Tuple[str, bytes]] = []
+        self.size = 0
+        self.future: concurrent.futures.Future | None = None
+
+    def add(self, filename: str, file_content: bytes) -> int:
+        self.files.append((filename, file_content))
+        self.size += len(file_content)
+        return len(self.files) - 1
+
+    def is_full(self) -> bool:
+        return len(self.files) >= ENCODE_BATCH_SIZE or self.size >= ENCODE_BATCH_BYTES
+
+    def submit(
+        self,
+        executor: concurrent.futures.Executor,
+        encode: Callable[[str, bytes], Tuple[str, bytes]],
+    ) -> None:
+        self.future = executor.submit(process_batch, encode, self.files)
+        # The worker has its own copy now; don't keep the sources alive.
+        self.files = []
+
+
+def copy_raw_entry(
+    book: zipfile.ZipFile, epub_file: zipfile.ZipFile, item: zipfile.ZipInfo
+) -> None:
+    """Copy an entry's compressed bytes verbatim, skipping inflate/deflate."""
+    zinfo = copy.copy(item)
+    # Sizes and CRC are known up front, so no trailing data descriptor.
+    zinfo.flag_bits &= ~0x08
+
+    with book._lock, epub_file._lock:
+        # The local header's extra field may differ from the central directory's.
+        book.fp.seek(item.header_offset)
+        header = book.fp.read(zipfile.sizeFileHeader)
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        book.fp.seek(name_length + extra_length, io.SEEK_CUR)
+
+        epub_file.fp.seek(epub_file.start_dir)
+        zinfo.header_offset = epub_file.fp.tell()
+        epub_file._writecheck(zinfo)
+        epub_file._didModify = True
+        epub_file.fp.write(zinfo.FileHeader())
+
+        remaining = item.compress_size
+        while remaining > 0:
+            chunk = book.fp.read(min(COPY_BUFFER_SIZE, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile(f"Truncated entry: {item.filename}")
+            epub_file.fp.write(chunk)
+            remaining -= len(chunk)
+
+        epub_file.filelist.append(zinfo)
+        epub_file.NameToInfo[zinfo.filename] = zinfo
+        epub_file.start_dir = epub_file.fp.tell()
+
+
+def write_entry(
     book: zipfile.ZipFile,
+    epub_file: zipfile.ZipFile,
+    item: zipfile.ZipInfo,
+    batch: Batch | None,
+    index: int,
+) -> None:
+    if batch is None:
+        copy_raw_entry(book, epub_file, item)
+        return
+
+    _, content = batch.future.result()[index]
+    # Deflating JPEG/WebP/AVIF data gains nothing but costs CPU.
+    compress_type = zipfile.ZIP_STORED if sniff_format(content) else item.compress_type
+    epub_file.writestr(item, content, compress_type=compress_type)
+
+
+Output = TypeVar("Output", bound=BinaryIO)
+
+
+@overload
+def compress_epub(
+    epub,
     quality: int,
     img_format: Literal["WEBP", "AVIF"],
-) -> Tuple[zipfile.ZipInfo, bytes]:
-    file_content = book.read(item.filename)
-    mime_type, _ = mimetypes.guess_type(item.filename)
+    codec: AvifCodec = ...,
+    speed: int = ...,
+    max_dimension: int | None = ...,
+    target_bpp: float | None = ...,
+    keep_alpha: bool = ...,
+    output: None = None,
+) -> io.BytesIO: ...
 
-    if (
-        mime_type
-        and mime_type.startswith("image")
-        and "cover" not in item.filename.lower()
-    ):
-        return item, convert_image(file_content, quality, img_format)
-    else:
-        return item, file_content
+
+@overload
+def compress_epub(
+    epub,
+    quality: int,
+    img_format: Literal["WEBP", "AVIF"],
+    codec: AvifCodec = ...,
+    speed: int = ...,
+    max_dimension: int | None = ...,
+    target_bpp: float | None = ...,
+    keep_alpha: bool = ...,
+    *,
+    output: Output,
+) -> Output: ...
 
 
 def compress_epub(
-    epub, quality: int, img_format: Literal["WEBP", "AVIF"]
-) -> io.BytesIO:
+    epub,
+    quality: int,
+    img_format: Literal["WEBP", "AVIF"],
+    codec: AvifCodec = "auto",
+    speed: int = DEFAULT_AVIF_SPEED,
+    max_dimension: int | None = DEFAULT_MAX_DIMENSION,
+    target_bpp: float | None = None,
+    keep_alpha: bool = False,
+    output: BinaryIO | None = None,
+) -> BinaryIO:
+    # An unavailable codec would otherwise fail inside every save and leave
+    # each image unconverted.
+    if img_format == "AVIF" and not avif_codec_available(codec):
+        raise ValueError(f"AVIF codec {codec!r} is not available in this libavif build")
+
     book = zipfile.ZipFile(epub)
-    file_list = book.infolist()
-    file = io.BytesIO()
+    manifest = read_manifest(book)
+    # Callers that don't need the bytes in memory can write straight to disk.
+    file = output if output is not None else io.BytesIO()
+
+    encode = functools.partial(
+        process_file,
+        quality=quality,
+        img_format=img_format,
+        codec=codec,
+        speed=speed,
+        max_dimension=max_dimension,
+        target_bpp=target_bpp,
+        keep_alpha=keep_alpha,
+    )
+
+    # Encoding is CPU-bound, so fan out across processes rather than threads.
+    # Half the cores leaves room for the encoders' own internal threads.
+    max_concurrent = (
+        MAX_CONCURRENT_AVIF_ENCODES if img_format == "AVIF" else MAX_CONCURRENT_ENCODES
+    )
+    max_workers = max(1, min(max_concurrent, (os.cpu_count() or 1) // 2))
+    # Batches allowed in flight before the oldest must be written out; this
+    # keeps memory flat regardless of how many images the book holds.
+    window = 2 * max_workers
 
     with zipfile.ZipFile(file, "w") as epub_file:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = [
-                executor.submit(process_file, item, book, quality, img_format)
-                for item in file_list
-            ]
-
-            for future in concurrent.futures.as_completed(futures):
-                item, content = future.result()
-                epub_file.writestr(item, content)
+        if MIMETYPE_ENTRY in book.NameToInfo:
+            epub_file.writestr(
+                zipfile.ZipInfo(MIMETYPE_ENTRY),
+                book.read(MIMETYPE_ENTRY),
+                compress_type=zipfile.ZIP_STORED,
+            )
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers
+        ) as executor:
+            # Entries are written in archive order; raw copies queue behind
+            # any encodes ahead of them.
+            pending: deque[Tuple[zipfile.ZipInfo, Batch | None, int]] = deque()
+            in_flight: set[Batch] = set()
+            batch = Batch()
+            # Identical images (repeated icons, chapter openers) share one
+            # encode. Only entries whose CRC and size recur can be reused, so
+            # count those up front and forget each shared encode once its
+            # last copy is queued; the blake2b digest guards CRC collisions.
+            duplicates = Counter(
+                (item.CRC, item.file_size)
+                for item in book.infolist()
+                if item.filename != MIMETYPE_ENTRY
+                and should_convert(item.filename, manifest)
+            )
+            encodes: dict[Tuple[int, int], Tuple[bytes, Batch, int]] = {}
+
+            # The source archive is only ever read from this thread, in one
+            # sequential pass; workers get plain bytes and never touch it.
+            for item in book.infolist():
+                if item.filename == MIMETYPE_ENTRY:
+                    continue
+
+                if not should_convert(item.filename, manifest):
+                    if pending:
+                        pending.append((item, None, 0))
+                    else:
+                        copy_raw_entry(book, epub_file, item)
+                    continue
+
+                file_content = book.read(item)
+                group = (item.CRC, item.file_size)
+                duplicates[group] -= 1
+                digest = None
+                if group in encodes or duplicates[group]:
+                    digest = hashlib.blake2b(file_content, digest_size=16).digest()
+
+                shared = encodes.get(group)
+                if shared and shared[0] == digest:
+                    pending.append((item, *shared[1:]))
+                else:
+                    index = batch.add(item.filename, file_content)
+                    pending.append((item, batch, index))
+                    if duplicates[group]:
+                        encodes[group] = digest, batch, index
+                if not duplicates[group]:
+                    encodes.pop(group, None)
+
+                if not batch.is_full():
+                    continue
+
+                # Everything older than the open batch has been submitted, so
+                # this never reaches an entry whose batch isn't running yet.
+                while len(in_flight) >= window:
+                    oldest, oldest_batch, index = pending.popleft()
+                    write_entry(book, epub_file, oldest, oldest_batch, index)
+                    in_flight.discard(oldest_batch)
+
+                batch.submit(executor, encode)
+                in_flight.add(batch)
+                batch = Batch()
+
+            if batch.files:
+                batch.submit(executor, encode)
+
+            while pending:
+                write_entry(book, epub_file, *pending.popleft())
 
     return file